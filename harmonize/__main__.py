@@ -1,17 +1,27 @@
 import argparse
 import asyncio
+import collections
+import concurrent.futures
 import contextlib
+import errno
 import fnmatch
 import functools
 import importlib.metadata
+import itertools
 import logging
 import os
 import pathlib
+import queue
+import re
 import shutil
-import tempfile
+import stat
+import sys
+import threading
 
 import mutagen
-import mutagen.mp3
+import mutagen.easyid3
+import mutagen.flac
+import mutagen.id3
 
 from . import decoders, encoders
 
@@ -23,6 +33,13 @@ except importlib.metadata.PackageNotFoundError:
     VERSION = 'unknown'
 
 
+# Paths are str. source_stat is taken during the scan and read only once as
+# the source file may change during transcode. target_mtime is None when the
+# target did not exist prior to the run.
+SyncItem = collections.namedtuple(
+    'SyncItem', ['source', 'source_stat', 'target', 'target_mtime', 'is_flac'])
+
+
 class Targets:
 
     def __init__(self, source_base, target_base, target_codec, exclude):
@@ -35,137 +52,332 @@ class Targets:
         self.exclude = set()
         if exclude:
             self.exclude.update(exclude)
-        self._paths = set()
-
-    def build_target_path(self, source_path):
+        # a single pattern matching any exclusion, compiled once
+        self._exclude_re = re.compile('|'.join(
+            fnmatch.translate(pattern) for pattern in self.exclude
+        )) if self.exclude else None
+        # names of expected target paths keyed by their parent directory
+        self._paths_by_parent = {}
+        # mtimes of all paths present in the target prior to the run
+        self._target_mtimes = {}
+        # paths are handled as str while scanning, which is much cheaper
+        # than pathlib. All scanned paths start with these prefixes.
+        self._source_prefix = os.path.join(source_base, '')
+        self._target_prefix = os.path.join(target_base, '')
+
+    def build_target_path(self, source_path, is_dir=None):
         """Return the corresponding target path for a FLAC path
 
-        :param pathlib.Path source_path: FLAC path
-        :rtype: pathlib.Path
+        :param str source_path: FLAC path
+        :param bool is_dir: Whether source_path is a directory. Checked
+            against the filesystem when not provided.
+        :rtype: str
         """
-        if source_path.is_dir():
-            name = source_path.name
-        else:
-            split_name = source_path.name.split('.')
-            if len(split_name) > 1 and split_name[-1].lower() == 'flac':
-                split_name[-1] = self.target_codec
-                name = '.'.join(split_name)
-                if pathlib.Path(source_path.parent, name).exists():
-                    # TODO: not sure how to handle this
-                    LOGGER.error('Duplicate file found: %s', source_path)
-                    raise NotImplementedError
-            else:
-                name = source_path.name
-
-        target_path = self.target_base.joinpath(
-            source_path.parent.relative_to(self.source_base), name)
-        self._paths.add(target_path)
+        source_path = os.fspath(source_path)
+        if is_dir is None:
+            is_dir = os.path.isdir(source_path)
+        parent, name = os.path.split(source_path)
+        # only the extension is lowercased, not the whole name
+        if not is_dir and name[-5:].lower() == '.flac':
+            name = name[:-4] + self.target_codec
+
+        target_path = self._target_prefix + os.path.join(
+            parent, name)[len(self._source_prefix):]
+        self._paths_by_parent.setdefault(
+            os.path.dirname(target_path), set()).add(name)
         return target_path
 
     def sanitize(self):
-        """Remove unexpected files and directories"""
-        for root, _, files in os.walk(self.target_base):
-            root_path = pathlib.Path(root)
-            root_path_source = pathlib.Path(
-                self.source_base,
-                root_path.relative_to(self.target_base)
-            )
-            if root_path_source.is_dir():
-                for path_str in files:
-                    path = pathlib.Path(root, path_str)
-                    if path not in self._paths:
-                        LOGGER.info('Deleting %s', path)
-                        _delete_if_exists(path)
-            else:
-                LOGGER.info('Deleting %s', root_path)
-                _delete_if_exists(root_path)
+        """Remove unexpected files and directories
+
+        Only paths present prior to the run are considered, so the target is
+        not scanned again.
+        """
+        deleted = set()
+        for path in sorted(self._target_mtimes):
+            parent, name = os.path.split(path)
+            if parent in deleted:
+                # removed along with its parent
+                deleted.add(path)
+            elif (name not in self._paths_by_parent.get(parent, ())
+                    and path not in self._paths_by_parent):
+                LOGGER.info('Deleting %s', path)
+                _delete_if_exists(path)
+                deleted.add(path)
+
+    def _index_targets(self):
+        """Record the mtime of every path present in the target
+
+        Symlinks to directories are recorded but not descended into, so
+        paths outside the target are never considered for removal.
+        """
+        if not os.path.isdir(self.target_base):
+            return
+        self._target_mtimes = {
+            entry.path: entry.stat(follow_symlinks=False).st_mtime
+            for entry in _all_paths(self.target_base, follow_symlinks=False)
+        }
 
     def _get_paths(self):
-        """Generator which returns a tuple of source and target paths
+        """Generator which returns the items to synchronize
 
-        :param pathlib.Path source_base:
-        :rtype: tuple
+        :rtype: SyncItem
         """
+        self._index_targets()
+
         LOGGER.info('Scanning "%s"', self.source_base)
         count = 0
-        for path in _all_paths(self.source_base):
-            excluded = False
-            for exclude in self.exclude:
-                if fnmatch.fnmatch(path, exclude):
-                    excluded = True
-
-            if not excluded:
-                target_path = self.build_target_path(path)
-                count += 1
-                yield path, target_path
+        # checked for clashes with transcoded names once the scan completes,
+        # rather than by a stat per FLAC file
+        scanned = set()
+        transcoded = []
+        for entry in _all_paths(self.source_base):
+            path = entry.path
+            scanned.add(path)
+            if self._exclude_re and self._exclude_re.match(path):
+                continue
+
+            is_dir = entry.is_dir()
+            is_flac = not is_dir and entry.name[-5:].lower() == '.flac'
+            if is_flac:
+                transcoded.append(path)
+            target_path = self.build_target_path(path, is_dir)
+            count += 1
+            yield SyncItem(
+                source=path,
+                source_stat=entry.stat(),
+                target=target_path,
+                target_mtime=self._target_mtimes.get(target_path),
+                is_flac=is_flac)
+
+        for path in transcoded:
+            if path[:-len('flac')] + self.target_codec in scanned:
+                # TODO: not sure how to handle this
+                LOGGER.error('Duplicate file found: %s', path)
+                raise NotImplementedError
         LOGGER.info('Scanned %d items', count)
 
 
 def _delete_if_exists(path):
     """Delete a file or directory if it exists
 
-    :param pathlib.Path path:
+    :param str path:
     """
     try:
-        if path.is_file():
-            path.unlink()
-        else:
+        if os.path.isdir(path) and not os.path.islink(path):
             shutil.rmtree(path)
+        else:
+            os.unlink(path)
     except FileNotFoundError:
         pass
 
 
-def _all_paths(root):
-    """Return a list of all files under a root path"""
-    stack = [root]
-    while stack:
-        for path in stack.pop().iterdir():
-            if path.is_dir():
-                stack.append(path)
-            yield path
+def _scandir_sorted(path):
+    """Return the entries of a directory sorted by inode
+
+    Visiting entries in inode order keeps metadata reads close to sequential
+    on spinning disks and many network filesystems.
+
+    :param path:
+    :rtype: list
+    """
+    with os.scandir(path) as entries:
+        return sorted(entries, key=os.DirEntry.inode)
 
 
-async def sync_path(source, target, encoder):
+def _all_paths(root, max_workers=None, follow_symlinks=True):
+    """Return a generator of all entries under a root path
+
+    Directories are scanned concurrently by a pool of threads, each taking a
+    pending directory off a shared stack and pushing any subdirectories back
+    onto it. Entries are yielded in no particular order.
+
+    Each entry is stat'ed by the scanning threads, so its cached stat is
+    free to the caller.
+
+    :param pathlib.Path root:
+    :param int max_workers: Number of scanning threads
+    :param bool follow_symlinks: Whether to descend into symlinks to
+        directories, and whether the cached stat follows symlinks
+    :rtype: os.DirEntry
+    """
+    if max_workers is None:
+        max_workers = min(32, (os.cpu_count() or 1) + 4)
+
+    pending = collections.deque([root])
+    condition = threading.Condition()
+    active = 0
+    found = queue.Queue()
+
+    def scan():
+        nonlocal active
+        try:
+            while True:
+                with condition:
+                    while not pending and active:
+                        condition.wait()
+                    if not pending:
+                        return
+                    path = pending.pop()
+                    active += 1
+                try:
+                    for entry in _scandir_sorted(path):
+                        if entry.is_dir(follow_symlinks=follow_symlinks):
+                            with condition:
+                                pending.append(entry.path)
+                                condition.notify()
+                        entry.stat(follow_symlinks=follow_symlinks)
+                        found.put(entry)
+                finally:
+                    with condition:
+                        active -= 1
+                        condition.notify_all()
+        finally:
+            found.put(None)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        futures = [executor.submit(scan) for _ in range(max_workers)]
+        remaining = max_workers
+        while remaining:
+            entry = found.get()
+            if entry is None:
+                remaining -= 1
+            else:
+                yield entry
+        for future in futures:
+            future.result()
+
+
+async def sync_path(item, codec, encoder, copy_executor=None):
     """Synchronize source path with target if out-of-sync
 
-    :param pathlib.Path source:
-    :param pathlib.Path target:
+    :param SyncItem item:
+    :param concurrent.futures.Executor copy_executor: Executor to copy files
+        other than FLAC with, keeping their I/O off the event loop
     """
-    if source.is_dir():
-        copy(source, target)
+    source_stat = item.source_stat
+    if stat.S_ISDIR(source_stat.st_mode):
+        copy(pathlib.Path(item.source), pathlib.Path(item.target))
     else:
-        # lstat the source only as source file may change during transcode
-        source_lstat = source.lstat()
+        if item.target_mtime == source_stat.st_mtime:
+            return
 
-        if target.exists() and target.lstat().st_mtime == source_lstat.st_mtime:
+        source, target = pathlib.Path(item.source), pathlib.Path(item.target)
+
+        if not item.is_flac:
+            await asyncio.get_running_loop().run_in_executor(
+                copy_executor, _copy_to_target, source, target, source_stat)
             return
 
-        target.parent.mkdir(parents=True, exist_ok=True)
+        # tags are read and written on the default executor, so other
+        # workers' transcodes are not stalled by the I/O
+        loop = asyncio.get_running_loop()
+        source_metadata = None
+        if codec in _CODEC_METADATA:
+            source_metadata = await loop.run_in_executor(
+                None, read_flac_metadata, source)
+            if item.target_mtime is not None:
+                retagged = await loop.run_in_executor(
+                    None, _retag_unchanged_audio,
+                    source, source_metadata, source_stat, target, codec)
+                if retagged:
+                    return
+
+        _ensure_dir(target.parent)
         with TempPath(dir=target.parent, suffix='.temp') as temp_target:
-            if source.suffix.lower() == '.flac':
-                await transcode(decoders.flac, encoder, source, temp_target)
-                copy_audio_metadata(source, temp_target)
-            else:
-                copy(source, temp_target)
-            copy_path_attr(source_lstat, temp_target)
+            await transcode(
+                _CODEC_DECODERS[codec], encoder, source, temp_target)
+            if source_metadata is not None:
+                await loop.run_in_executor(
+                    None, _tag_transcoded,
+                    source_metadata, temp_target, codec)
+            copy_path_attr(source_stat, temp_target)
             temp_target.rename(target)
 
 
-def copy_path_attr(source_lstat, target):
-    target.chmod(source_lstat.st_mode)
+def _retag_unchanged_audio(source, source_metadata, source_stat, target,
+                           codec):
+    """Update the tags of a target transcoded from the same audio
+
+    The tags are written to a copy which then replaces the target, so the
+    target is never left half-written and may be read-only.
+
+    :param pathlib.Path source: FLAC path
+    :param FLACMetadata source_metadata: FLAC metadata
+    :param os.stat_result source_stat: FLAC stat
+    :param pathlib.Path target: Transcoded path
+    :param str codec: Codec of the transcoded file
+    :returns: Whether the target was updated
+    :rtype: bool
+    """
+    target_metadata = _unchanged_audio_metadata(
+        source_metadata, target, codec)
+    if target_metadata is None:
+        return False
+    LOGGER.info('Updating tags of %s', source)
+    with TempPath(dir=target.parent, suffix='.temp') as temp_target:
+        _copy_file(target, temp_target)
+        _tag_transcoded(source_metadata, temp_target, codec)
+        copy_path_attr(source_stat, temp_target)
+        temp_target.rename(target)
+    return True
+
+
+def _tag_transcoded(source_metadata, target, codec):
+    copy_audio_metadata(source_metadata, _CODEC_METADATA[codec](target))
+
+
+def _copy_to_target(source, target, source_stat):
+    """Copy a file to a temporary path, then move it over the target
+
+    :param pathlib.Path source: Source path
+    :param pathlib.Path target: Target path
+    :param os.stat_result source_stat: Source stat
+    """
+    LOGGER.info('Copying %s', source)
+    _ensure_dir(target.parent)
+    with TempPath(dir=target.parent, suffix='.temp') as temp_target:
+        _copy_file(source, temp_target, source_stat)
+        temp_target.rename(target)
+
+
+# directories known to exist, so each is created at most once per run
+_CREATED_DIRS = set()
+
+
+def _ensure_dir(path):
+    """Create a directory and its parents if not already done by this run
+
+    :param pathlib.Path path:
+    """
+    path = os.fspath(path)
+    if path not in _CREATED_DIRS:
+        os.makedirs(path, exist_ok=True)
+        _CREATED_DIRS.add(path)
+
+
+def copy_path_attr(source_stat, target):
+    """Copy the mode and modified time of a source to a target
+
+    :param os.stat_result source_stat: Source stat
+    :param target: Target path or open file descriptor
+    """
+    os.chmod(target, source_stat.st_mode)
     os.utime(
         target,
-        (target.lstat().st_atime, source_lstat.st_mtime)
+        (os.stat(target).st_atime, source_stat.st_mtime)
     )
 
 
-def copy(source, target):
+def copy(source, target, source_stat=None):
     """Copy a file while retaining the original's modified time
 
     Creates parent directories if they do not exist.
 
     :param pathlib.Path source: Source path
     :param pathlib.Path source: Target path
+    :param os.stat_result source_stat: Source stat. When provided, its mode
+        and modified time are applied to the copied file.
     """
     if source.is_dir():
         if target.exists():
@@ -177,44 +389,237 @@ def copy(source, target):
         target.mkdir(exist_ok=True, parents=True)
     else:
         LOGGER.info('Copying %s', source)
-        target.parent.mkdir(parents=True, exist_ok=True)
-        shutil.copy(source, target)
+        _ensure_dir(target.parent)
+        _copy_file(source, target, source_stat)
+
+
+# errors indicating the filesystems involved do not support an in-kernel copy
+_COPY_UNSUPPORTED = {
+    errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL}
+
+
+def _copy_file(source, target, source_stat=None):
+    """Copy a file's contents, within the kernel where possible
+
+    Uses copy_file_range, which avoids copying data through user space and
+    shares extents on filesystems supporting reflinks, falling back to
+    sendfile and then to an ordinary copy where unavailable.
+
+    :param pathlib.Path source: Source path
+    :param pathlib.Path target: Target path
+    :param os.stat_result source_stat: Source stat to copy the mode and
+        modified time from
+    """
+    with open(source, 'rb') as source_file, \
+            open(target, 'wb') as target_file:
+        _copy_contents(source_file, target_file)
+        if source_stat is not None:
+            # applied through the open file, sparing path lookups
+            target_file.flush()
+            copy_path_attr(source_stat, target_file.fileno())
+
+
+def _copy_contents(source_file, target_file):
+    source_fd, target_fd = source_file.fileno(), target_file.fileno()
+    # both calls copy from the current offsets, so a fallback resumes
+    # wherever the previous method stopped
+    if hasattr(os, 'copy_file_range'):
+        try:
+            if _copy_until_eof(os.copy_file_range, source_fd, target_fd):
+                return
+        except OSError as e:
+            if e.errno not in _COPY_UNSUPPORTED:
+                raise
+    # elsewhere sendfile requires a socket to write to, as in shutil
+    if sys.platform.startswith('linux'):
+        try:
+            if _copy_until_eof(_sendfile, source_fd, target_fd):
+                return
+        except OSError as e:
+            if e.errno not in _COPY_UNSUPPORTED:
+                raise
+    shutil.copyfileobj(source_file, target_file)
+
+
+def _copy_until_eof(copy_range, source_fd, target_fd):
+    """Copy between descriptors until the source is exhausted
+
+    Some filesystems copy nothing rather than raising an error where the
+    method is unsupported, so as in shutil, the caller falls back to
+    another method when nothing is copied. An empty source is copied by
+    the fallback all the same.
+
+    :param copy_range: os.copy_file_range or an equivalent
+    :returns: Whether anything was copied
+    :rtype: bool
+    """
+    copied = 0
+    while True:
+        size = copy_range(source_fd, target_fd, 1 << 30)
+        if not size:
+            return bool(copied)
+        copied += size
+
+
+def _sendfile(source_fd, target_fd, count):
+    return os.sendfile(target_fd, source_fd, None, count)
+
+
+# distinguishes temporary paths created by this process
+_TEMP_COUNTER = itertools.count()
 
 
 @contextlib.contextmanager
-def TempPath(**kwargs):
-    """Wrapper around tempfile.NamedTemporaryFile which returns a path object
+def TempPath(dir, suffix=''):
+    """Provide a unique path for a temporary file
 
-    Unlike tempfile.NamedTemporaryFile, the FileNotFoundError exception is not
-    raised if the file is deleted before the context closes.
+    Unlike tempfile.NamedTemporaryFile, the file is not created. The name is
+    derived from the process ID and a counter, saving the syscalls spent
+    creating a placeholder which the caller then overwrites. The file is
+    deleted when the context closes if it exists.
 
+    :param pathlib.Path dir: Directory of the temporary file
+    :param str suffix: Suffix of the temporary file's name
     :rtype: pathlib.Path
     """
-    with tempfile.NamedTemporaryFile(**kwargs, delete=False) as tmp:
-        temp_path = pathlib.Path(tmp.name)
+    temp_path = pathlib.Path(
+        dir, f'tmp{os.getpid()}.{next(_TEMP_COUNTER)}{suffix}')
+    try:
+        yield temp_path
+    finally:
         try:
-            yield temp_path
-        finally:
-            try:
-                temp_path.unlink()
-            except FileNotFoundError:
-                pass
+            temp_path.unlink()
+        except FileNotFoundError:
+            pass
 
 
-def copy_audio_metadata(source, target):
-    source_metadata = mutagen.File(source, easy=True)
-    target_metadata = mutagen.File(target, easy=True)
-    if target_metadata is None:
-        # this will barf for other types
-        target_metadata = mutagen.mp3.EasyMP3(target)
-    for key, value in source_metadata.items():
+# FLAC metadata needed to tag transcoded files
+FLACMetadata = collections.namedtuple('FLACMetadata', ['info', 'tags'])
+
+_FLAC_STREAMINFO = 0
+_FLAC_VORBIS_COMMENT = 4
+
+
+def read_flac_metadata(path):
+    """Read the stream info and tags of a FLAC file
+
+    Unlike mutagen.flac.FLAC, every other metadata block is skipped rather
+    than read, sparing megabytes of embedded pictures.
+
+    :param pathlib.Path path: FLAC path
+    :rtype: FLACMetadata
+    """
+    info = tags = None
+    with open(path, 'rb') as f:
+        header = f.read(10)
+        if header[:3] == b'ID3':
+            # an ID3v2 tag may precede the FLAC stream
+            size = 0
+            for byte in header[6:10]:
+                size = (size << 7) | (byte & 0x7F)
+            f.seek(10 + size)
+            header = f.read(4)
+        else:
+            f.seek(4)
+        if header[:4] != b'fLaC':
+            raise mutagen.flac.FLACNoHeaderError(f'{path} is not a FLAC file')
+
+        last = False
+        while not last and (info is None or tags is None):
+            block_header = f.read(4)
+            if len(block_header) < 4:
+                break
+            last = bool(block_header[0] & 0x80)
+            block_type = block_header[0] & 0x7F
+            size = int.from_bytes(block_header[1:], 'big')
+            if block_type == _FLAC_STREAMINFO:
+                info = mutagen.flac.StreamInfo(f.read(size))
+            elif block_type == _FLAC_VORBIS_COMMENT and tags is None:
+                tags = mutagen.flac.VCFLACDict(f.read(size))
+            else:
+                f.seek(size, os.SEEK_CUR)
+
+    if info is None:
+        raise mutagen.flac.FLACNoHeaderError(
+            f'{path} has no stream info block')
+    if tags is None:
+        tags = mutagen.flac.VCFLACDict()
+    return FLACMetadata(info=info, tags=tags)
+
+
+def copy_audio_metadata(source_metadata, target_metadata):
+    """Copy tags from a FLAC file to a transcoded file
+
+    Tags no longer present in the FLAC file are removed. The MD5 of the
+    FLAC's audio is recorded alongside the tags.
+
+    :param FLACMetadata source_metadata: FLAC metadata
+    :param target_metadata: Transcoded file metadata
+    """
+    for key in list(target_metadata.keys()):
+        del target_metadata[key]
+    for key, value in source_metadata.tags.items():
         try:
             target_metadata[key] = value
         except KeyError:
-            LOGGER.debug('Cannot set tag "%s" for %s', key, target)
+            LOGGER.debug(
+                'Cannot set tag "%s" for %s', key, target_metadata.filename)
+    if source_metadata.info.md5_signature:
+        target_metadata[_AUDIO_MD5_KEY] = _audio_md5(source_metadata)
     target_metadata.save()
 
 
+# the MD5 of the decoded audio a target was transcoded from, as recorded in
+# the STREAMINFO of the source FLAC
+_AUDIO_MD5_KEY = 'harmonize_md5'
+mutagen.easyid3.EasyID3.RegisterTXXXKey(_AUDIO_MD5_KEY, 'HARMONIZE_MD5')
+
+
+def _audio_md5(source_metadata):
+    return format(source_metadata.info.md5_signature, '032x')
+
+
+def _unchanged_audio_metadata(source_metadata, target, codec):
+    """Return the metadata of a target transcoded from the same audio
+
+    Targets whose audio is unchanged only need their tags updated, such as
+    when the FLAC file was retagged or its modified time was reset.
+
+    :param FLACMetadata source_metadata: FLAC metadata
+    :param pathlib.Path target: Transcoded path
+    :param str codec: Codec of the transcoded file
+    :returns: Target metadata, or None if the audio may differ
+    """
+    # not all FLAC encoders record an MD5
+    if not source_metadata.info.md5_signature:
+        return None
+    try:
+        target_metadata = _CODEC_METADATA[codec](target)
+    except (mutagen.MutagenError, OSError):
+        return None
+    if target_metadata.get(_AUDIO_MD5_KEY) != [_audio_md5(source_metadata)]:
+        return None
+    return target_metadata
+
+
+def _load_easyid3(path):
+    """Load the ID3 tags of an MP3 file
+
+    Unlike mutagen.mp3.EasyMP3, the audio frames are not scanned for the
+    stream info, which is never used here.
+
+    :param pathlib.Path path: MP3 path
+    :rtype: mutagen.easyid3.EasyID3
+    """
+    tags = mutagen.easyid3.EasyID3()
+    try:
+        tags.load(path)
+    except mutagen.id3.ID3NoHeaderError:
+        # untagged, save() writes a new tag
+        tags.filename = os.fspath(path)
+    return tags
+
+
 async def transcode(decoder, encoder, source, target):
     """Transcode a FLAC file to MP3
 
@@ -222,7 +627,7 @@ async def transcode(decoder, encoder, source, target):
     :param pathlib.Path target:
     """
     LOGGER.info('Transcoding %s', source)
-    target.parent.mkdir(parents=True, exist_ok=True)
+    _ensure_dir(target.parent)
     async with decoder(source) as decoded:
         await encoder(decoded, target)
 
@@ -232,48 +637,38 @@ _CODEC_ENCODERS = {
     'opus': encoders.opus
 }
 
+# opusenc copies tags from its FLAC input itself. Those targets are always
+# transcoded again when out-of-sync as they carry no MD5 of their audio.
+_CODEC_METADATA = {
+    'mp3': _load_easyid3,
+}
 
-class AsyncExecutor:
-    def __init__(self, max_pending=None):
-        self._max_pending = max_pending
-        self._queued = []
-        self._pending = set()
-
-    def submit(self, func, *args, **kwargs):
-        self._queued.append((func, args, kwargs))
-        try:
-            asyncio.get_running_loop()
-        except RuntimeError:
-            pass
-        else:
-            self._fill()
+# opusenc reads FLAC input directly
+_CODEC_DECODERS = {
+    'mp3': decoders.flac,
+    'opus': decoders.passthrough
+}
 
-    async def as_completed(self):
-        while self._queued or self._pending:
-            self._fill()
 
-            done, self._pending = await asyncio.wait(
-                self._pending, return_when=asyncio.FIRST_COMPLETED)
+# default number of files other than FLAC copied concurrently
+_COPY_WORKERS = 16
 
-            for result in done:
-                yield result
 
-    def _fill(self):
-        for _ in range(self._max_pending - len(self._pending)):
-            if not self._queued:
-                return
-            func, args, kwargs = self._queued.pop()
-            self._pending.add(asyncio.create_task(func(*args, **kwargs)))
+def _schedule_order(item):
+    """Sort key for the order in which paths are synchronized
 
+    Directories come first, then FLAC files from largest to smallest, then
+    everything else. Transcodes take far longer than copies, so starting the
+    longest first avoids one being left to run alone at the end.
 
-async def run(executor):
-    async for result in executor.as_completed():
-        try:
-            result = result.result()
-        except Exception as e:
-            print('error', type(e).__name__, e)
-        else:
-            print('slept', result)
+    :param SyncItem item:
+    :rtype: tuple
+    """
+    if stat.S_ISDIR(item.source_stat.st_mode):
+        return (0, 0, item.source)
+    if item.is_flac:
+        return (1, -item.source_stat.st_size, item.source)
+    return (2, 0, item.source)
 
 
 async def async_run(args, encoder_options):
@@ -283,17 +678,68 @@ async def async_run(args, encoder_options):
         args.source, args.target, args.codec,
         exclude=args.exclude)
 
-    executor = AsyncExecutor(args.num_processes)
-    for source, target in sorted(targets._get_paths()):
-        executor.submit(sync_path, source, target, encoder)
-    async for result in executor.as_completed():
-        result.result()
+    directories, transcodes, copies = [], [], []
+    for item in sorted(targets._get_paths(), key=_schedule_order):
+        if stat.S_ISDIR(item.source_stat.st_mode):
+            directories.append(item)
+        elif item.is_flac:
+            transcodes.append(item)
+        else:
+            copies.append(item)
+
+    with concurrent.futures.ThreadPoolExecutor(
+            args.copy_workers) as copy_executor:
+
+        async def worker(items):
+            for item in items:
+                await sync_path(item, args.codec, encoder, copy_executor)
+
+        # created before any files, so none are written where one belongs
+        await worker(directories)
+
+        # workers share a single iterator of paths rather than a task per
+        # path. Transcodes are CPU bound so run one per process, while
+        # copies are I/O bound and benefit from many more in flight.
+        transcodes, copies = iter(transcodes), iter(copies)
+        await asyncio.gather(
+            *(worker(transcodes) for _ in range(args.num_processes)),
+            *(worker(copies) for _ in range(args.copy_workers)))
 
     targets.sanitize()
 
     LOGGER.info('Processing complete')
 
 
+def _positive_int(value):
+    """argparse type for options which must be at least 1
+
+    :param str value:
+    :rtype: int
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(
+            f'must be a positive integer: {value!r}')
+    return number
+
+
+def _available_cpus():
+    """Return the number of CPUs this process may run on
+
+    Unlike os.cpu_count, respects CPU affinity such as that set by taskset or
+    a container's cpuset.
+
+    :rtype: int
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -303,8 +749,14 @@ def main():
     parser.add_argument(
         '-n', dest='num_processes',
         help='Number of processes to use',
-        type=int,
-        default=os.cpu_count())
+        type=_positive_int,
+        default=_available_cpus())
+    parser.add_argument(
+        '--copy-workers', metavar='NUM_COPIES',
+        help=('Number of files other than FLAC to copy concurrently '
+              '(default: %(default)s)'),
+        type=_positive_int,
+        default=_COPY_WORKERS)
     parser.add_argument(
         '-q', '--quiet', action='store_true',
         help='suppress informational output')
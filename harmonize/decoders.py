@@ -1,30 +1,228 @@
 import asyncio
+import concurrent.futures
 import contextlib
+import functools
+import io
 import logging
 import os
+import struct
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 LOGGER = logging.getLogger(__name__)
 
+# Linux only. fcntl.F_SETPIPE_SZ is not exposed prior to Python 3.10.
+_F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+_PIPE_SIZE = 1 << 20
+
+
+def _pipe():
+    """Create a pipe with a buffer large enough to hold many PCM frames
+
+    The default 64 KiB buffer forces frequent context switches between the
+    decoder and encoder. The size is left as-is where it cannot be changed.
+
+    :rtype: tuple
+    """
+    read_pipe, write_pipe = os.pipe()
+    if fcntl is not None:
+        try:
+            fcntl.fcntl(write_pipe, _F_SETPIPE_SZ, _PIPE_SIZE)
+        except OSError:
+            pass
+    return read_pipe, write_pipe
+
+
+@contextlib.contextmanager
+def _open_sequential(path):
+    """Open a file which is read once from start to end
+
+    The kernel is advised to read ahead further than usual, and the file's
+    pages are dropped from the cache once it is closed as nothing reads it
+    again during the run. Only the descriptor provided is closed, copies
+    handed to other processes are left to them.
+
+    :param pathlib.Path path:
+    :rtype: int
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        yield fd
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+@functools.lru_cache(maxsize=None)
+def _import_soundfile():
+    """Return the soundfile module, or None if it is not installed
+
+    Imported on first use rather than with this module as it pulls in numpy,
+    which is slow to import and of no use to runs which never decode FLAC
+    in-process, such as opus or up-to-date targets.
+    """
+    try:
+        import soundfile
+    except ImportError:
+        return None
+    return soundfile
+
 
 @contextlib.asynccontextmanager
 async def flac(path):
-    """Decode a FLAC file
+    """Decode a FLAC file to 16-bit WAV
+
+    Decodes in-process with soundfile when it is installed, otherwise with
+    the flac command.
+
+    The decoded WAV is provided either as a file descriptor, which the
+    encoder is responsible for closing, or as a binary stream which remains
+    owned by the decoder. Encoders needing a descriptor use :func:`as_fd`.
+
+    :param pathlib.Path path: The FLAC file path
+    """
+    decoder = _flac_soundfile if _import_soundfile() else _flac_process
+    async with decoder(path) as decoded:
+        yield decoded
+
+
+@contextlib.asynccontextmanager
+async def _flac_soundfile(path):
+    """Decode a FLAC file in-process as it is read
+
+    No thread or pipe is involved, PCM is decoded straight into the buffers
+    of whoever reads the stream.
+
+    :param pathlib.Path path: The FLAC file path
+    """
+    with _open_sequential(path) as fd, \
+            _import_soundfile().SoundFile(fd, closefd=False) as sound_file, \
+            _SoundFileWAVReader(sound_file) as reader:
+        yield reader
+
+
+class _SoundFileWAVReader(io.RawIOBase):
+    """Read a SoundFile as a 16-bit WAV stream
+
+    Reads return whole frames once past the header.
+    """
+
+    def __init__(self, sound_file):
+        self._sound_file = sound_file
+        self._frame_size = sound_file.channels * 2
+        data_size = min(sound_file.frames * self._frame_size, 0xFFFFFFFF - 36)
+        self._header = memoryview(struct.pack(
+            '<4sI4s4sIHHIIHH4sI',
+            b'RIFF', data_size + 36, b'WAVE',
+            b'fmt ', 16, 1, sound_file.channels, sound_file.samplerate,
+            sound_file.samplerate * self._frame_size, self._frame_size, 16,
+            b'data', data_size))
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        buffer = memoryview(buffer).cast('B')
+        if self._header:
+            size = min(len(buffer), len(self._header))
+            buffer[:size] = self._header[:size]
+            self._header = self._header[size:]
+            return size
+
+        frames = len(buffer) // self._frame_size
+        if not frames:
+            raise ValueError('Buffer is smaller than a frame')
+        # decode directly into the reader's buffer
+        frames = self._sound_file.buffer_read_into(
+            buffer[:frames * self._frame_size], dtype='int16')
+        return frames * self._frame_size
+
+
+@contextlib.asynccontextmanager
+async def as_fd(decoded):
+    """Provide decoded audio as a file descriptor
+
+    Descriptors are provided as-is. Streams are written to a pipe on a
+    dedicated thread, which is not taken from the event loop's default
+    executor as it blocks until the encoder consumes the PCM, which may
+    itself be waiting on a thread from the default executor.
+
+    The encoder is responsible for closing the descriptor.
+
+    :param decoded: A file descriptor or binary stream
+    """
+    if isinstance(decoded, int):
+        yield decoded
+        return
+
+    read_pipe, write_pipe = _pipe()
+    stop = threading.Event()
+    loop = asyncio.get_running_loop()
+    with concurrent.futures.ThreadPoolExecutor(2) as executor:
+        pumping = loop.run_in_executor(
+            executor, _pump, decoded, write_pipe, stop)
+        try:
+            # the encoder closes its copy, this one remains for draining
+            yield os.dup(read_pipe)
+        except BaseException:
+            # the encoder may not have read everything, unblock the pump
+            stop.set()
+            await loop.run_in_executor(executor, _drain, read_pipe)
+            # a decode error is the likely cause of the encoder's error
+            with contextlib.suppress(BrokenPipeError):
+                await pumping
+            raise
+        else:
+            await pumping
+        finally:
+            os.close(read_pipe)
+
+
+def _pump(stream, write_pipe, stop):
+    with open(write_pipe, 'wb') as output:
+        # a single reused buffer, written to the pipe as-is
+        block = bytearray(_PIPE_SIZE)
+        view = memoryview(block)
+        while not stop.is_set():
+            size = stream.readinto(block)
+            if not size:
+                break
+            output.write(view[:size])
+
+
+def _drain(read_pipe):
+    while os.read(read_pipe, _PIPE_SIZE):
+        pass
+
+
+@contextlib.asynccontextmanager
+async def _flac_process(path):
+    """Decode a FLAC file with the flac command
 
     Decodes through any errors.
 
     :param pathlib.Path path: The FLAC file path
     """
-    read_pipe, write_pipe = os.pipe()
+    read_pipe, write_pipe = _pipe()
 
-    proc = await asyncio.create_subprocess_exec(
-        'flac', '-csd', path,
-        stdout=write_pipe,
-        stderr=asyncio.subprocess.PIPE)
+    with _open_sequential(path) as source:
+        proc = await asyncio.create_subprocess_exec(
+            'flac', '-csd', '-',
+            stdin=source,
+            stdout=write_pipe,
+            stderr=asyncio.subprocess.PIPE)
 
-    os.close(write_pipe)
+        os.close(write_pipe)
 
-    yield read_pipe
-    await proc.wait()
+        yield read_pipe
+        await proc.wait()
     # Decode errors may are non-fatal, but may indicate a problem
     stderr = await proc.stderr.read()
     if proc.returncode:
@@ -35,3 +233,16 @@ async def flac(path):
         )
     if stderr:
         LOGGER.warning('Decode "%s" "%s"', path, stderr)
+
+
+@contextlib.asynccontextmanager
+async def passthrough(path):
+    """Provide a FLAC file as-is for encoders which decode FLAC natively
+
+    Avoids spawning a separate decoder process.
+
+    :param pathlib.Path path: The FLAC file path
+    """
+    with _open_sequential(path) as fd:
+        # the encoder closes its copy
+        yield os.dup(fd)
@@ -1,10 +1,188 @@
 import asyncio
+import contextlib
+import io
 import os
+import struct
 
+from . import decoders
 
-async def lame(stdin_pipe, target, options=[]):
+try:
+    import lameenc
+except ImportError:
+    lameenc = None
+
+_WAVE_FORMAT_PCM = 0x0001
+_WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# Read size when encoding in-process. A multiple of any PCM frame size.
+_CHUNK_SIZE = 1 << 20
+
+# Space reserved for an ID3v2 tag at the start of MP3 files. Tags copied
+# afterwards are written into it in place rather than by moving the audio.
+_ID3V2_PADDING = 4096
+
+
+async def lame(decoded, target, options=[]):
+    """Encode WAV data to MP3
+
+    Encodes in-process with lameenc when it is installed and understands the
+    options, falling back to the lame command otherwise.
+
+    :param decoded: A file descriptor or binary stream of WAV data
+    """
+    settings = _lameenc_settings(options) if lameenc else None
+    if settings is None:
+        async with decoders.as_fd(decoded) as stdin_pipe:
+            await _lame_process(stdin_pipe, target, options)
+        return
+
+    if isinstance(decoded, int):
+        # Unbuffered so no PCM is read ahead while parsing the header
+        stdin = open(decoded, 'rb', buffering=0)
+    else:
+        # owned by the decoder
+        stdin = contextlib.nullcontext(decoded)
+
+    loop = asyncio.get_running_loop()
+    with stdin as stdin:
+        wav_format = await loop.run_in_executor(None, _read_wav_header, stdin)
+        format_tag, channels, sample_rate, bits_per_sample = wav_format
+        if channels > 2:
+            raise ValueError(f'Unsupported number of channels: {channels}')
+
+        if format_tag == _WAVE_FORMAT_PCM and bits_per_sample == 16:
+            if isinstance(decoded, int):
+                # pipe reads may end mid-frame
+                stdin = io.BufferedReader(stdin, _CHUNK_SIZE)
+            await loop.run_in_executor(
+                None, _lameenc_encode, stdin,
+                target, settings, channels, sample_rate)
+        else:
+            # The header is consumed, so describe the remaining PCM to lame
+            raw_options = [
+                '-r', '-s', sample_rate / 1000,
+                '--bitwidth', bits_per_sample,
+                # 8-bit WAV is unsigned
+                '--unsigned' if bits_per_sample == 8 else '--signed',
+                '--little-endian'
+            ]
+            if channels == 1:
+                raw_options += ['-m', 'm']
+            if isinstance(decoded, int):
+                remaining = os.dup(stdin.fileno())
+            else:
+                remaining = stdin
+            async with decoders.as_fd(remaining) as stdin_pipe:
+                await _lame_process(
+                    stdin_pipe, target, [*raw_options, *options])
+
+
+def _lameenc_settings(options):
+    """Translate lame command options to lameenc settings
+
+    :param list options: lame command options
+    :returns: lameenc.Encoder method names and arguments, or None if any
+        option is not supported
+    :rtype: list
+
+    VBR is not supported as lameenc does not rewrite the Xing header once
+    encoding completes, leaving players unable to determine the duration.
+    """
+    settings = []
+    options = [str(o) for o in options]
+    while options:
+        option = options.pop(0)
+        if option[:2] in ('-b', '-q') and len(option) > 2:
+            option, value = option[:2], option[2:]
+        elif option in ('-b', '-q') and options:
+            value = options.pop(0)
+        else:
+            return None
+
+        try:
+            value = int(value)
+        except ValueError:
+            return None
+
+        if option == '-b':
+            settings.append(('set_bit_rate', value))
+        else:
+            settings.append(('set_quality', value))
+    return settings
+
+
+def _read_exactly(stream, size):
+    data = b''
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            raise EOFError('Truncated WAV header')
+        data += chunk
+    return data
+
+
+def _read_wav_header(stream):
+    """Read a WAV header, leaving the stream at the start of the PCM data
+
+    :returns: format tag, channels, sample rate, and bits per sample
+    :rtype: tuple
+    """
+    riff, _, wave = struct.unpack('<4sI4s', _read_exactly(stream, 12))
+    if riff != b'RIFF' or wave != b'WAVE':
+        raise ValueError('Not a WAV stream')
+
+    wav_format = None
+    while True:
+        chunk_id, size = struct.unpack('<4sI', _read_exactly(stream, 8))
+        if chunk_id == b'data':
+            if wav_format is None:
+                raise ValueError('WAV format chunk missing')
+            return wav_format
+
+        # chunks are padded to an even size
+        data = _read_exactly(stream, size + size % 2)
+        if chunk_id == b'fmt ':
+            format_tag, channels, sample_rate = struct.unpack_from(
+                '<HHI', data)
+            bits_per_sample, = struct.unpack_from('<H', data, 14)
+            if format_tag == _WAVE_FORMAT_EXTENSIBLE:
+                format_tag, = struct.unpack_from('<H', data, 24)
+            wav_format = (format_tag, channels, sample_rate, bits_per_sample)
+
+
+def _lameenc_encode(stdin, target, settings, channels, sample_rate):
+    encoder = lameenc.Encoder()
+    encoder.set_channels(channels)
+    encoder.set_in_sample_rate(sample_rate)
+    for name, value in settings:
+        getattr(encoder, name)(value)
+
+    with open(target, 'wb') as output:
+        output.write(_empty_id3v2_tag(_ID3V2_PADDING))
+        while True:
+            pcm = stdin.read(_CHUNK_SIZE)
+            if not pcm:
+                break
+            output.write(encoder.encode(pcm))
+        output.write(encoder.flush())
+
+
+def _empty_id3v2_tag(padding):
+    """Return an ID3v2.4 tag consisting only of padding
+
+    :param int padding: Number of padding bytes
+    :rtype: bytes
+    """
+    # the tag size is a 28-bit "synchsafe" integer
+    size = bytes((padding >> shift) & 0x7F for shift in (21, 14, 7, 0))
+    return b'ID3\x04\x00\x00' + size + bytes(padding)
+
+
+async def _lame_process(stdin_pipe, target, options):
     proc = await asyncio.create_subprocess_exec(
-        'lame', '--quiet', *[str(o) for o in options], '-', target,
+        'lame', '--quiet',
+        '--id3v2-only', '--pad-id3v2-size', str(_ID3V2_PADDING),
+        *[str(o) for o in options], '-', target,
         stdin=stdin_pipe,
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.PIPE)
@@ -23,9 +201,17 @@ async def lame(stdin_pipe, target, options=[]):
         )
 
 
-async def opus(stdin_pipe, target, options=[]):
+async def opus(decoded, target, options=[]):
+    async with decoders.as_fd(decoded) as stdin_pipe:
+        await _opus_process(stdin_pipe, target, options)
+
+
+async def _opus_process(stdin_pipe, target, options):
+    # FLAC input is passed through, from which opusenc would otherwise copy
+    # embedded pictures as well as tags
     proc = await asyncio.create_subprocess_exec(
-        'opusenc', '--quiet', *[str(o) for o in options], '-', target,
+        'opusenc', '--quiet', '--discard-pictures',
+        *[str(o) for o in options], '-', target,
         stdin=stdin_pipe)
     os.close(stdin_pipe)
 
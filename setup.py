@@ -13,6 +13,10 @@ setuptools.setup(
     long_description=REPO.joinpath('README.rst').read_text(),
     url='https://github.com/nvllsvm/harmonize',
     install_requires=['mutagen>=1.40.0'],
+    extras_require={
+        'lameenc': ['lameenc'],
+        'soundfile': ['soundfile'],
+    },
     license='Apache 2.0',
     packages=['harmonize'],
     entry_points={
@@ -1 +1 @@
-from . import ffmpeg, ffprobe  # noqa: F401
+from . import ffmpeg, ffprobe, flac  # noqa: F401
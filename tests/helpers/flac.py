@@ -0,0 +1,88 @@
+import hashlib
+import struct
+
+_BLOCK_SIZE = 4096
+_SAMPLE_RATE = 44100
+
+
+def write_metadata_only(dest, md5):
+    """Write a FLAC file consisting only of a STREAMINFO block
+
+    :param bytes md5: MD5 signature of the (absent) decoded audio
+    """
+    with open(dest, 'wb') as f:
+        f.write(b'fLaC')
+        f.write(_streaminfo(channels=2, total_samples=0, md5=md5))
+
+
+def write_verbatim(dest, frames):
+    """Write a 44.1 kHz, 16-bit FLAC file storing its samples uncompressed
+
+    :param list frames: Tuples of one signed sample per channel
+    """
+    channels = len(frames[0])
+    pcm = b''.join(struct.pack(f'<{channels}h', *frame) for frame in frames)
+    with open(dest, 'wb') as f:
+        f.write(b'fLaC')
+        f.write(_streaminfo(
+            channels, len(frames), hashlib.md5(pcm).digest()))
+        for number, start in enumerate(range(0, len(frames), _BLOCK_SIZE)):
+            f.write(_frame(number, frames[start:start + _BLOCK_SIZE]))
+
+
+def _streaminfo(channels, total_samples, md5):
+    # sample rate, channels, bits per sample and total samples
+    packed = ((_SAMPLE_RATE << 44) | ((channels - 1) << 41) | (15 << 36)
+              | total_samples)
+    streaminfo = struct.pack(
+        '>HH3s3sQ', _BLOCK_SIZE, _BLOCK_SIZE, b'\0' * 3, b'\0' * 3,
+        packed) + md5
+    # the only, and so last, metadata block
+    return bytes([0x80]) + len(streaminfo).to_bytes(3, 'big') + streaminfo
+
+
+def _frame(number, frames):
+    channels = len(frames[0])
+    # fixed block size, block size stored at the end of the header,
+    # 44.1 kHz, independent channels, 16 bits per sample. A frame number
+    # below 128 is coded as a single byte.
+    header = bytes([
+        0xFF, 0xF8, 0x79, ((channels - 1) << 4) | 0x08, number
+    ]) + struct.pack('>H', len(frames) - 1)
+    header += bytes([_crc8(header)])
+    # verbatim subframes
+    subframes = b''.join(
+        b'\x02' + struct.pack(f'>{len(frames)}h', *samples)
+        for samples in zip(*frames))
+    frame = header + subframes
+    return frame + struct.pack('>H', _crc16(frame))
+
+
+def _crc_table(polynomial, width):
+    top = 1 << (width - 1)
+    mask = (1 << width) - 1
+    table = []
+    for byte in range(256):
+        crc = byte << (width - 8)
+        for _ in range(8):
+            crc = ((crc << 1) ^ polynomial if crc & top else crc << 1) & mask
+        table.append(crc)
+    return table
+
+
+_CRC8_TABLE = _crc_table(0x07, 8)
+_CRC16_TABLE = _crc_table(0x8005, 16)
+
+
+def _crc8(data):
+    crc = 0
+    for byte in data:
+        crc = _CRC8_TABLE[crc ^ byte]
+    return crc
+
+
+def _crc16(data):
+    crc = 0
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFF) ^ _CRC16_TABLE[(crc >> 8) ^ byte]
+    return crc
@@ -1,8 +1,15 @@
+import os
 import pathlib
 import shutil
+import stat
 import subprocess
 import unittest
+import unittest.mock
 
+import mutagen.flac
+import mutagen.id3
+
+from harmonize.__main__ import _copy_file, read_flac_metadata
 from tests import helpers
 
 TMP = pathlib.Path(__file__).parent.joinpath('tmp')
@@ -143,3 +150,217 @@ class TestApp(unittest.TestCase):
         self.assertEqual(
             text_file.read_text(),
             (target_dir / 'other.txt').read_text())
+
+    def test_copies_nested_directories(self):
+        source_dir = TMP / 'source'
+        target_dir = TMP / 'target'
+        relative_paths = [
+            pathlib.Path('a', 'b', 'c', 'one.txt'),
+            pathlib.Path('a', 'two.txt'),
+            pathlib.Path('d', 'three.txt'),
+        ]
+        for relative_path in relative_paths:
+            path = source_dir / relative_path
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(str(relative_path))
+
+        proc = subprocess.run(
+            ['harmonize', str(source_dir), str(target_dir)],
+            stderr=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            check=True)
+        self.assertEqual(proc.stdout, b'')
+
+        stderr = proc.stderr.decode().splitlines()
+        self.assertEqual(
+            stderr[0:2],
+            [f'Scanning "{source_dir}"',
+             'Scanned 7 items'])
+
+        self.assertEqual(
+            sorted(path.relative_to(target_dir)
+                   for path in target_dir.rglob('*')
+                   if path.is_file()),
+            sorted(relative_paths))
+        for relative_path in relative_paths:
+            self.assertEqual(
+                (target_dir / relative_path).read_text(),
+                str(relative_path))
+
+    def test_removes_unexpected_paths(self):
+        source_dir = TMP / 'source'
+        target_dir = TMP / 'target'
+        (source_dir / 'album').mkdir(parents=True)
+        (source_dir / 'album' / 'other.txt').write_text('test file')
+
+        unexpected_file = target_dir / 'album' / 'unexpected.txt'
+        unexpected_dir = target_dir / 'removed'
+        unexpected_file.parent.mkdir(parents=True)
+        unexpected_file.write_text('unexpected')
+        (unexpected_dir / 'nested').mkdir(parents=True)
+        (unexpected_dir / 'nested' / 'file.txt').write_text('unexpected')
+
+        subprocess.run(
+            ['harmonize', '-q', str(source_dir), str(target_dir)],
+            check=True)
+
+        self.assertFalse(unexpected_file.exists())
+        self.assertFalse(unexpected_dir.exists())
+        self.assertEqual(
+            sorted(path.relative_to(target_dir)
+                   for path in target_dir.rglob('*')),
+            [pathlib.Path('album'),
+             pathlib.Path('album', 'other.txt')])
+
+    def test_excludes_matching_paths(self):
+        source_dir = TMP / 'source'
+        source_dir.mkdir()
+        target_dir = TMP / 'target'
+        (source_dir / 'kept.txt').write_text('test file')
+        (source_dir / 'excluded.log').write_text('test file')
+        (source_dir / 'excluded.cue').write_text('test file')
+
+        proc = subprocess.run(
+            ['harmonize',
+             '--exclude', '*.log', '--exclude', '*/excluded.cue',
+             str(source_dir), str(target_dir)],
+            stderr=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            check=True)
+        self.assertEqual(proc.stdout, b'')
+        self.assertEqual(
+            proc.stderr.decode(),
+            (f'Scanning "{source_dir}"\n'
+             'Scanned 1 items\n'
+             f'Copying {source_dir}/kept.txt\n'
+             'Processing complete\n'))
+
+        self.assertEqual(
+            [path.name for path in target_dir.iterdir()],
+            ['kept.txt'])
+
+    def test_retags_unchanged_audio_without_transcoding(self):
+        source_dir = TMP / 'source'
+        source_dir.mkdir()
+        target_dir = TMP / 'target'
+        audio_file = source_dir / 'audio.flac'
+        helpers.ffmpeg.generate_silence(1, audio_file)
+        # copied to the target, which must still be updated
+        audio_file.chmod(0o444)
+
+        subprocess.run(
+            ['harmonize', '-q', str(source_dir), str(target_dir)],
+            check=True)
+
+        # only the modified time changes, the audio is the same
+        source_mtime = audio_file.stat().st_mtime - 60
+        os.utime(audio_file, (source_mtime, source_mtime))
+
+        proc = subprocess.run(
+            ['harmonize', str(source_dir), str(target_dir)],
+            stderr=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            check=True)
+        self.assertEqual(proc.stdout, b'')
+        self.assertEqual(
+            proc.stderr.decode(),
+            (f'Scanning "{source_dir}"\n'
+             'Scanned 1 items\n'
+             f'Updating tags of {audio_file}\n'
+             'Processing complete\n'))
+
+        target_stat = (target_dir / 'audio.mp3').stat()
+        self.assertEqual(audio_file.stat().st_mtime, target_stat.st_mtime)
+        self.assertEqual(0o444, stat.S_IMODE(target_stat.st_mode))
+
+    def test_does_not_descend_into_symlinked_target_directories(self):
+        source_dir = TMP / 'source'
+        target_dir = TMP / 'target'
+        external_dir = TMP / 'external'
+        (source_dir / 'album').mkdir(parents=True)
+        (source_dir / 'album' / 'other.txt').write_text('test file')
+
+        external_dir.mkdir()
+        external_file = external_dir / 'precious.txt'
+        external_file.write_text('precious')
+        target_dir.mkdir()
+        (target_dir / 'album').symlink_to(external_dir)
+        (target_dir / 'loop').symlink_to(target_dir)
+
+        subprocess.run(
+            ['harmonize', '-q', str(source_dir), str(target_dir)],
+            check=True)
+
+        self.assertEqual(external_file.read_text(), 'precious')
+        self.assertFalse(os.path.lexists(target_dir / 'loop'))
+        self.assertEqual(
+            (target_dir / 'album' / 'other.txt').read_text(),
+            'test file')
+
+    def test_reads_flac_metadata_like_mutagen(self):
+        audio_file = TMP / 'audio.flac'
+        helpers.flac.write_metadata_only(audio_file, bytes(range(16)))
+        metadata = mutagen.flac.FLAC(audio_file)
+        metadata['artist'] = ['A', 'B']
+        metadata['title'] = 'T'
+        picture = mutagen.flac.Picture()
+        picture.data = os.urandom(3 * 1024 * 1024)
+        metadata.add_picture(picture)
+        # the picture precedes the tags, so must be skipped to reach them
+        block_order = [mutagen.flac.StreamInfo, mutagen.flac.Picture]
+        metadata.metadata_blocks.sort(key=lambda block: (
+            block_order.index(type(block))
+            if type(block) in block_order else len(block_order)))
+        metadata.save()
+
+        def assert_matches_mutagen():
+            expected = mutagen.flac.FLAC(audio_file)
+            actual = read_flac_metadata(audio_file)
+            self.assertEqual(expected.tags.items(), actual.tags.items())
+            self.assertEqual(
+                expected.info.md5_signature, actual.info.md5_signature)
+
+        assert_matches_mutagen()
+
+        # an ID3v2 tag may precede the FLAC stream
+        id3 = mutagen.id3.ID3()
+        id3.add(mutagen.id3.TIT2(text='ID3'))
+        id3.save(audio_file)
+        self.assertEqual(audio_file.read_bytes()[:3], b'ID3')
+        assert_matches_mutagen()
+
+    def test_read_flac_metadata_rejects_other_files(self):
+        text_file = TMP / 'other.txt'
+        text_file.write_text('test file')
+
+        with self.assertRaises(mutagen.flac.FLACNoHeaderError):
+            read_flac_metadata(text_file)
+
+    def test_copy_falls_back_when_nothing_is_copied(self):
+        source_file = TMP / 'source.bin'
+        source_file.write_bytes(os.urandom(1024 * 1024))
+        target_file = TMP / 'target.bin'
+
+        # as some filesystems do where in-kernel copies are unsupported
+        with unittest.mock.patch(
+                'os.copy_file_range', return_value=0, create=True), \
+                unittest.mock.patch('os.sendfile', return_value=0):
+            _copy_file(source_file, target_file)
+
+        self.assertEqual(source_file.read_bytes(), target_file.read_bytes())
+
+    def test_rejects_non_positive_worker_counts(self):
+        source_dir = TMP / 'source'
+        source_dir.mkdir()
+        target_dir = TMP / 'target'
+
+        for option in ('-n', '--copy-workers'):
+            proc = subprocess.run(
+                ['harmonize', option, '0', str(source_dir), str(target_dir)],
+                stderr=subprocess.PIPE,
+                stdout=subprocess.PIPE)
+            self.assertEqual(proc.returncode, 2)
+            self.assertIn(
+                f'argument {option}: must be a positive integer',
+                proc.stderr.decode())
+        self.assertFalse(target_dir.exists())
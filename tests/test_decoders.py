@@ -0,0 +1,97 @@
+import asyncio
+import io
+import os
+import pathlib
+import shutil
+import struct
+import unittest
+
+from harmonize import decoders, encoders
+from tests import helpers
+
+TMP = pathlib.Path(__file__).parent.joinpath('tmp')
+
+# more PCM than fits in the pipe between as_fd and an encoder
+_FRAMES = [(i % 300 - 150, -(i % 77)) for i in range(300000)]
+_PCM = b''.join(struct.pack('<2h', *frame) for frame in _FRAMES)
+
+
+@unittest.skipUnless(
+    decoders._import_soundfile(), 'soundfile is not installed')
+class TestSoundFileDecoder(unittest.TestCase):
+
+    def setUp(self):
+        try:
+            shutil.rmtree(TMP)
+        except FileNotFoundError:
+            pass
+        TMP.mkdir()
+        self.audio_file = TMP / 'audio.flac'
+        helpers.flac.write_verbatim(self.audio_file, _FRAMES)
+
+    def test_reads_wav(self):
+        async def decode():
+            async with decoders.flac(self.audio_file) as decoded:
+                # the header is served across short reads
+                header = b''
+                while len(header) < 44:
+                    buffer = bytearray(10)
+                    header += buffer[:decoded.readinto(buffer)]
+
+                # reads return whole frames only
+                buffer = bytearray(6)
+                self.assertEqual(decoded.readinto(buffer), 4)
+                pcm = bytes(buffer[:4])
+                with self.assertRaises(ValueError):
+                    decoded.readinto(bytearray(3))
+
+                pcm += decoded.read()
+                return header, pcm
+
+        header, pcm = asyncio.run(decode())
+
+        self.assertEqual(len(header), 44)
+        self.assertEqual(
+            encoders._read_wav_header(io.BytesIO(header)),
+            (encoders._WAVE_FORMAT_PCM, 2, 44100, 16))
+        self.assertEqual(pcm, _PCM)
+
+    def test_as_fd(self):
+        async def decode():
+            async with decoders.flac(self.audio_file) as decoded:
+                async with decoders.as_fd(decoded) as fd:
+                    with open(fd, 'rb') as wav:
+                        return wav.read()
+
+        wav = asyncio.run(decode())
+
+        self.assertEqual(wav[44:], _PCM)
+
+    def test_as_fd_encoder_error(self):
+        async def decode():
+            async with decoders.flac(self.audio_file) as decoded:
+                async with decoders.as_fd(decoded) as fd:
+                    # stop reading while the pump is blocked on the pipe
+                    os.read(fd, 10)
+                    os.close(fd)
+                    raise RuntimeError('encoder failed')
+
+        open_fds = len(os.listdir('/proc/self/fd'))
+        with self.assertRaisesRegex(RuntimeError, 'encoder failed'):
+            asyncio.run(decode())
+        self.assertEqual(open_fds, len(os.listdir('/proc/self/fd')))
+
+
+class TestAsFd(unittest.TestCase):
+
+    def test_passes_descriptors_through(self):
+        async def provide(fd):
+            async with decoders.as_fd(fd) as provided:
+                return provided
+
+        read_pipe, write_pipe = os.pipe()
+        try:
+            self.assertEqual(asyncio.run(provide(read_pipe)), read_pipe)
+        finally:
+            os.close(read_pipe)
+            os.close(write_pipe)
@@ -0,0 +1,159 @@
+import asyncio
+import io
+import os
+import pathlib
+import shutil
+import struct
+import unittest
+import unittest.mock
+
+import mutagen.mp3
+
+from harmonize import encoders
+
+TMP = pathlib.Path(__file__).parent.joinpath('tmp')
+
+
+def _wav(chunks):
+    # chunks are padded to an even size
+    body = b''.join(
+        struct.pack('<4sI', chunk_id, len(data))
+        + data + b'\0' * (len(data) % 2)
+        for chunk_id, data in chunks)
+    return b'RIFF' + struct.pack('<I', len(body) + 4) + b'WAVE' + body
+
+
+def _fmt(format_tag=1, channels=2, sample_rate=44100, bits_per_sample=16):
+    block_align = channels * bits_per_sample // 8
+    return struct.pack(
+        '<HHIIHH', format_tag, channels, sample_rate,
+        sample_rate * block_align, block_align, bits_per_sample)
+
+
+def _fmt_extensible(sub_format, channels=2, sample_rate=44100,
+                    bits_per_sample=24):
+    return (
+        _fmt(encoders._WAVE_FORMAT_EXTENSIBLE, channels, sample_rate,
+             bits_per_sample)
+        # cbSize, valid bits, channel mask, then the sub format GUID
+        + struct.pack('<HHI', 22, bits_per_sample, 3)
+        + struct.pack('<H', sub_format) + b'\0' * 14)
+
+
+class TestLameencSettings(unittest.TestCase):
+
+    def test_no_options(self):
+        self.assertEqual(encoders._lameenc_settings([]), [])
+
+    def test_bit_rate_and_quality(self):
+        expected = [('set_bit_rate', 192), ('set_quality', 2)]
+        self.assertEqual(
+            encoders._lameenc_settings(['-b', '192', '-q', '2']), expected)
+        self.assertEqual(
+            encoders._lameenc_settings(['-b192', '-q2']), expected)
+        self.assertEqual(
+            encoders._lameenc_settings(['-b', 192, '-q', 2]), expected)
+
+    def test_unsupported_options(self):
+        for options in (['-V2'], ['-V', '2'], ['--preset', 'extreme'],
+                        ['-b', '192', '-m', 'm'], ['-b'], ['-b', 'high'],
+                        ['-bhigh']):
+            with self.subTest(options=options):
+                self.assertIsNone(encoders._lameenc_settings(options))
+
+
+class TestReadWavHeader(unittest.TestCase):
+
+    def test_pcm(self):
+        stream = io.BytesIO(_wav([(b'fmt ', _fmt()), (b'data', b'\1\2')]))
+        self.assertEqual(
+            encoders._read_wav_header(stream), (1, 2, 44100, 16))
+        # left at the start of the PCM data
+        self.assertEqual(stream.read(), b'\1\2')
+
+    def test_extensible(self):
+        stream = io.BytesIO(_wav([
+            (b'fmt ', _fmt_extensible(encoders._WAVE_FORMAT_PCM)),
+            (b'data', b'')]))
+        self.assertEqual(
+            encoders._read_wav_header(stream), (1, 2, 44100, 24))
+
+    def test_skips_padded_chunks(self):
+        stream = io.BytesIO(_wav([
+            (b'LIST', b'odd'), (b'fmt ', _fmt(channels=1)),
+            (b'data', b'\1\2')]))
+        self.assertEqual(
+            encoders._read_wav_header(stream), (1, 1, 44100, 16))
+        self.assertEqual(stream.read(), b'\1\2')
+
+    def test_truncated(self):
+        header = _wav([(b'fmt ', _fmt()), (b'data', b'')])
+        for size in (0, 11, 20, len(header) - 1):
+            with self.subTest(size=size):
+                with self.assertRaises(EOFError):
+                    encoders._read_wav_header(io.BytesIO(header[:size]))
+
+    def test_missing_format(self):
+        with self.assertRaises(ValueError):
+            encoders._read_wav_header(io.BytesIO(_wav([(b'data', b'')])))
+
+    def test_not_wav(self):
+        with self.assertRaises(ValueError):
+            encoders._read_wav_header(io.BytesIO(b'fLaC' + b'\0' * 40))
+
+
+@unittest.skipUnless(encoders.lameenc, 'lameenc is not installed')
+class TestLameenc(unittest.TestCase):
+
+    def setUp(self):
+        try:
+            shutil.rmtree(TMP)
+        except FileNotFoundError:
+            pass
+        TMP.mkdir()
+
+    def test_encodes_wav_stream(self):
+        target = TMP / 'audio.mp3'
+        # one second of 16-bit stereo silence
+        wav = _wav([(b'fmt ', _fmt()), (b'data', bytes(44100 * 4))])
+
+        asyncio.run(encoders.lame(io.BytesIO(wav), target, ['-b', '128']))
+
+        data = target.read_bytes()
+        self.assertEqual(
+            data[:10], encoders._empty_id3v2_tag(encoders._ID3V2_PADDING)[:10])
+        metadata = mutagen.mp3.MP3(target)
+        self.assertEqual(metadata.info.bitrate, 128000)
+        self.assertTrue(1 <= metadata.info.length <= 1.1)
+
+
+class TestLameFallback(unittest.TestCase):
+
+    def _encode(self, wav, options):
+        """Encode with the lame command replaced, returning its arguments"""
+        calls = []
+
+        async def lame_process(stdin_pipe, target, options):
+            with open(stdin_pipe, 'rb') as stdin:
+                calls.append((stdin.read(), options))
+
+        with unittest.mock.patch.object(
+                encoders, '_lame_process', lame_process):
+            asyncio.run(encoders.lame(io.BytesIO(wav), os.devnull, options))
+        return calls
+
+    def test_unsupported_options(self):
+        wav = _wav([(b'fmt ', _fmt()), (b'data', b'\1\2\3\4')])
+        self.assertEqual(self._encode(wav, ['-V2']), [(wav, ['-V2'])])
+
+    @unittest.skipUnless(encoders.lameenc, 'lameenc is not installed')
+    def test_unsupported_bit_depth(self):
+        wav = _wav([
+            (b'fmt ', _fmt_extensible(encoders._WAVE_FORMAT_PCM)),
+            (b'data', b'\1\2\3\4\5\6')])
+        # the header is consumed, so the PCM is described to lame instead
+        self.assertEqual(
+            self._encode(wav, ['-b', '192']),
+            [(b'\1\2\3\4\5\6',
+              ['-r', '-s', 44.1, '--bitwidth', 24, '--signed',
+               '--little-endian', '-b', '192'])])